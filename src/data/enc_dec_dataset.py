@@ -15,12 +15,18 @@
 
 """GPT2 style dataset."""
 
+import mmap
 import os
 import time
 import token
 
 import numpy as np
 import torch
+try:
+    import numba
+    numba_available = True
+except ImportError:
+    numba_available = False
 from data_utils.tokenization_enc_dec import EncDecTokenizer
 
 from utils import print_rank_0
@@ -29,6 +35,10 @@ from data.indexed_dataset import make_dataset as make_indexed_dataset
 from data.indexed_dataset import MMapIndexedDataset
 
 
+# Target data dtypes `helpers.build_enc_dec_sample` has overloads for.
+_HELPERS_TARGET_DTYPES = (np.dtype(np.uint16), np.dtype(np.int32), np.dtype(np.int64))
+
+
 def get_train_valid_test_split_(splits_string, size):
     """ Get dataset splits from comma or '/' separated string list."""
 
@@ -139,6 +149,9 @@ class EncDecDataset(torch.utils.data.Dataset):
         self.tokenizer = tokenizer
         self.enc_seq_length = enc_seq_length
         self.dec_seq_length = dec_seq_length
+        # Look-up table of the sentinel token ids, indexed by sentinel number.
+        self.sentinel_ids = np.array([tokenizer.get_sentinel_id(k) for k in range(tokenizer.get_sentinel_num())],
+                                     dtype=np.int64)
 
         # Checks
         assert np.min(documents) >= 0
@@ -150,153 +163,198 @@ class EncDecDataset(torch.utils.data.Dataset):
             num_samples, enc_seq_length - 1, seed)
             # NOTE: enc_seq_length - 1: This function is originally designed for autoregressive models, so the output length is actually input length +1
 
+        # Sample building runs in the C++ helpers when they are available and
+        # have an overload for the target data dtype. A helpers module built
+        # from an older helpers.cpp may lack it.
+        self.build_sample = _build_enc_dec_sample
+        if np.dtype(target_indexed_dataset.dtype) in _HELPERS_TARGET_DTYPES:
+            try:
+                from data import helpers
+                self.build_sample = getattr(helpers, 'build_enc_dec_sample', _build_enc_dec_sample)
+            except ImportError:
+                pass
+        print_rank_0(' > building {} samples with {}'.format(
+            self.name, 'C++ helpers' if self.build_sample is not _build_enc_dec_sample else 'python'))
+
     def __len__(self):
         # -1 is due to data structure used to retieve the index:
         #    sample i --> [sample_idx[i], sample_idx[i+1])
         return self.sample_idx.shape[0] - 1
 
     def __getitem__(self, idx):
+        spans, = self.prefetch([idx])
+        sample = {
+            "contexts": np.empty(self.enc_seq_length, dtype=np.int64),
+            "targets": np.empty(self.dec_seq_length, dtype=np.int64),
+            "labels": np.empty(self.dec_seq_length, dtype=np.int64),
+            "ctx_eod_mask": np.empty(self.enc_seq_length, dtype=np.int64)
+        }
+        self.build_sample_into(spans, sample)
+        # Zero-copy tensor views, so the DataLoader pins them and the copy to
+        # the GPU can run asynchronously.
+        return {key: torch.from_numpy(value) for key, value in sample.items()}
+
+    def prefetch(self, indices):
+        """Advise the kernel to read the context and target offset spans of
+        all the given samples, so their reads are all in flight before the
+        first one is touched. Returns the spans of each sample, as given by
+        `_get_doc_spans`, to be passed on to `build_sample_into`."""
+        spans_list = []
+        for idx in indices:
+            doc_ids, context_spans = self._get_doc_spans(idx)
+            for doc_id, offset, length in context_spans:
+                self.context_indexed_dataset.will_need(doc_id, offset=offset, length=length)
+            for doc_id in doc_ids:
+                self.target_offset_dataset.will_need(doc_id)
+            spans_list.append((doc_ids, context_spans))
+        return spans_list
+
+    def _get_doc_spans(self, idx):
+        """Documents of sample idx and the (doc_id, offset, length) spans of
+        their contexts that make up the sample."""
         # Get the shuffled index.
         # NOTE: We do not get shuffle idx because the documents are already shuffled
         idx = self.shuffle_idx[idx]
             
         # Start and end documents and offsets.
-        doc_index_f = self.sample_idx[idx][0]
-        doc_index_l = self.sample_idx[idx + 1][0]
-        offset_f = self.sample_idx[idx][1]
-        offset_l = self.sample_idx[idx + 1][1]
+        doc_index_f = int(self.sample_idx[idx, 0])
+        doc_index_l = int(self.sample_idx[idx + 1, 0])
+        offset_f = int(self.sample_idx[idx, 1])
+        offset_l = int(self.sample_idx[idx + 1, 1])
         # If we are within the same document, just extract the chunk.
-        
-        targets_list = []
-        
         if doc_index_f == doc_index_l:
-            contexts = self.context_indexed_dataset.get(self.doc_idx[doc_index_f],
-                                              offset=offset_f,
-                                              length=offset_l - offset_f + 1)
-            contexts = [int(x) for x in contexts]
-            ctx_eod_mask = [0 for _ in range(len(contexts))]
-            target_offset = self.target_offset_dataset.get(self.doc_idx[doc_index_f])
-            sentinel_count = 0
-            for i in range(len(contexts)):
-                token_id = contexts[i]
-                assert token_id != self.tokenizer.eod_id
-                if token_id >= self.tokenizer.vocab_size:
-                    x = token_id - self.tokenizer.vocab_size
-                    # get sentinel id
-                    sentinel_id = self.tokenizer.get_sentinel_id(sentinel_count)
-                    # get target
-                    target = self.target_indexed_dataset.get(self.doc_idx[doc_index_f], offset=target_offset[2 * x], length=target_offset[2 * x + 1])
-                    target = [int(x) for x in target]
-
-                    # mark the eod pos in context
-                    if self.tokenizer.eod_id in target:
-                        ctx_eod_mask[i] = 1
-
-                    assert target[0] == token_id, (target[0], token_id)
-                    contexts[i] = sentinel_id
-                    target[0] = sentinel_id
-
-                    targets_list.append(target)
-
-                    sentinel_count += 1
-
+            doc_ids = [self.doc_idx[doc_index_f]]
+            context_spans = [(doc_ids[0], offset_f, offset_l - offset_f + 1)]
         else:
+            doc_ids = [self.doc_idx[i] for i in range(doc_index_f, doc_index_l + 1)]
             # Otherwise, get the rest of the initial document.
-            contexts_list = [self.context_indexed_dataset.get(self.doc_idx[doc_index_f], offset=offset_f)]
-            target_offset_list = [self.target_offset_dataset.get(self.doc_idx[doc_index_f])]
+            context_spans = [(doc_ids[0], offset_f, None)]
             # Loop over all in between documents and add the entire document.
-            for i in range(doc_index_f + 1, doc_index_l):
-                contexts_list.append(self.context_indexed_dataset.get(self.doc_idx[i]))
-                target_offset_list.append(self.target_offset_dataset.get(self.doc_idx[i]))
+            for doc_id in doc_ids[1:-1]:
+                context_spans.append((doc_id, 0, None))
             # And finally add the relevant portion of last document.
-            contexts_list.append(self.context_indexed_dataset.get(self.doc_idx[doc_index_l], length=offset_l + 1))
-            target_offset_list.append(self.target_offset_dataset.get(self.doc_idx[doc_index_l]))
-            
-            contexts_list = [[int(x) for x in tmp_contexts] for tmp_contexts in contexts_list]
-
-            sentinel_count = 0
-            ctx_eod_mask_list = []
-            for (k, tmp_contexts), tmp_target_offset in zip(enumerate(contexts_list), target_offset_list):
-                tmp_ctx_eod_mask = [0 for _ in tmp_contexts]
-                for i in range(len(tmp_contexts)):
-                    token_id = tmp_contexts[i]
-                    assert token_id != self.tokenizer.eod_id
-                    if token_id >= self.tokenizer.vocab_size:
-                        x = token_id - self.tokenizer.vocab_size
-                        # get sentinel id
-                        sentinel_id = self.tokenizer.get_sentinel_id(sentinel_count)
-                        # get target
-                        target = self.target_indexed_dataset.get(self.doc_idx[doc_index_f + k], offset=tmp_target_offset[2 * x], length=tmp_target_offset[2 * x + 1])
-                        target = [int(x) for x in target]
-
-                        # mark the eod pos in context
-                        if self.tokenizer.eod_id in target:
-                            tmp_ctx_eod_mask[i] = 1
-                        
-                        assert target[0] == token_id, (target[0], token_id)
-                        tmp_contexts[i] = sentinel_id
-                        target[0] = sentinel_id
-
-                        targets_list.append(target)
-
-                        sentinel_count += 1
-
-                ctx_eod_mask_list.append(tmp_ctx_eod_mask)
-            
-            contexts = [x for y in contexts_list for x in y]
-            ctx_eod_mask = [x for y in ctx_eod_mask_list for x in y]
-
-        targets = [x for y in targets_list for x in y]
-        targets = [1] + targets
-
-        # targets = []
-        # sentinel_count = 0
-        # ctx_eod_mask = [0 for _ in range(len(contexts))]
-        # for i in range(len(contexts)):
-        #     token_id = contexts[i]
-        #     assert token_id != self.tokenizer.eod_id
-        #     if token_id >= self.tokenizer.vocab_size:
-        #         # get sentinel id
-        #         sentinel_id = self.tokenizer.get_sentinel_id(sentinel_count)
-        #         # get the targets
-        #         target = self.target_indexed_dataset.get(self.target_offset)
-        #         target = [int(x) for x in target]
-
-        #         # mark the eod pos in context
-        #         if self.tokenizer.eod_id in target:
-        #             ctx_eod_mask[i] = 1
-        #         assert int(token_id) == int(target[0]), "{}, {}".format(token_id, target[0])
-        #         # replace with local sentinel ids
-        #         contexts[i] = sentinel_id
-        #         target[0] = sentinel_id
-        #         targets.extend(target)
-        #         sentinel_count += 1
-
-        targets.append(self.tokenizer.get_sentinel_id(sentinel_count))
+            context_spans.append((doc_ids[-1], 0, offset_l + 1))
+        return doc_ids, context_spans
+
+    def build_sample_into(self, spans, out):
+        """Build the sample with the given spans into `out`, a dict of int64
+        arrays with the same keys as the samples returned by __getitem__."""
+        doc_ids, context_spans = spans
+        contexts_list = [self.context_indexed_dataset.get(doc_id, offset=offset, length=length)
+                         for doc_id, offset, length in context_spans]
+        target_offset_list = [self.target_offset_dataset.get(doc_id) for doc_id in doc_ids]
+
+        contexts_length = sum(len(doc_contexts) for doc_contexts in contexts_list)
+        assert contexts_length == self.enc_seq_length, "contexts length({}) must equal enc_seq_length({})".format(contexts_length, self.enc_seq_length)
+        # Copy the documents out of the read-only mmap straight into the
+        # output, where sentinels can be written back.
+        contexts = out["contexts"]
+
+        # Locate every sentinel and the element range of its target in the
+        # target data file, and prefetch those ranges per document.
+        sentinel_pos_list = [np.zeros(0, dtype=np.int64)]
+        target_starts_list = [np.zeros(0, dtype=np.int64)]
+        target_lengths_list = [np.zeros(0, dtype=np.int64)]
+        base = 0
+        for k, (doc_contexts, tmp_target_offset) in enumerate(zip(contexts_list, target_offset_list)):
+            tmp_contexts = contexts[base:base + len(doc_contexts)]
+            tmp_contexts[:] = doc_contexts
+            assert not np.any(tmp_contexts == self.tokenizer.eod_id)
+            sentinel_pos = np.flatnonzero(tmp_contexts >= self.tokenizer.vocab_size)
+            if len(sentinel_pos) > 0:
+                x = tmp_contexts[sentinel_pos] - self.tokenizer.vocab_size
+                offsets = tmp_target_offset[2 * x].astype(np.int64)
+                lengths = tmp_target_offset[2 * x + 1].astype(np.int64)
+                begin, end = offsets.min(), (offsets + lengths).max()
+                self.target_indexed_dataset.will_need(doc_ids[k], offset=int(begin), length=int(end - begin))
+                sentinel_pos_list.append(base + sentinel_pos)
+                target_starts_list.append(self.target_indexed_dataset.element_offset(doc_ids[k]) + offsets)
+                target_lengths_list.append(lengths)
+            base += len(tmp_contexts)
+
+        self.build_sample(
+            contexts, out["ctx_eod_mask"], out["targets"], out["labels"],
+            self.target_indexed_dataset.data,
+            np.concatenate(sentinel_pos_list), np.concatenate(target_starts_list),
+            np.concatenate(target_lengths_list), self.sentinel_ids,
+            self.tokenizer.eod_id, self.tokenizer.pad_id)
 
         # if torch.distributed.get_rank() == 0:
         #     print("context", self.tokenizer.decode(contexts))
-        #     print("target", self.tokenizer.decode(targets))
-
-        assert len(contexts) == self.enc_seq_length, "contexts length({}) must equal enc_seq_length({})".format(len(contexts), self.enc_seq_length)
-        if len(targets) > self.dec_seq_length + 1:
-            print("targets length({}) maybe too long, cut to dec_seq_length + 1({})".format(len(targets), self.dec_seq_length + 1))
-            targets = targets[:self.dec_seq_length+1]
-
-        labels = targets[1:]
-        targets = targets[:-1]
-
-        assert len(targets) <= self.dec_seq_length, "target length: {}, length constrain: {}".format(len(targets), self.dec_seq_length)
-
-        targets = targets + [self.tokenizer.pad_id] * (self.dec_seq_length - len(targets))
-        labels = labels + [self.tokenizer.pad_id] * (self.dec_seq_length - len(labels))
-
-        return {
-            "contexts": np.array(contexts), 
-            "targets": np.array(targets), 
-            "labels": np.array(labels),
-            "ctx_eod_mask": np.array(ctx_eod_mask)
+        #     print("target", self.tokenizer.decode(out["targets"]))
+
+
+class EncDecBatchDataset(torch.utils.data.Dataset):
+    """Builds whole batches of an EncDecDataset. Indexed with the list of
+    sample indices of a batch, so it is meant to be used with a batch sampler
+    passed as the `sampler` of a DataLoader with batch_size=None. Samples are
+    built straight into the rows of the batch tensors instead of being
+    stacked by the default collate function. It has no `__len__`, the
+    DataLoader takes its length from the batch sampler."""
+
+    def __init__(self, dataset: EncDecDataset):
+        self.dataset = dataset
+
+    def __getitem__(self, indices):
+        batch_size = len(indices)
+        batch = {
+            "contexts": torch.empty((batch_size, self.dataset.enc_seq_length), dtype=torch.int64),
+            "targets": torch.empty((batch_size, self.dataset.dec_seq_length), dtype=torch.int64),
+            "labels": torch.empty((batch_size, self.dataset.dec_seq_length), dtype=torch.int64),
+            "ctx_eod_mask": torch.empty((batch_size, self.dataset.enc_seq_length), dtype=torch.int64)
         }
+        if torch.utils.data.get_worker_info() is not None:
+            # In a worker, allocate in shared memory directly like
+            # default_collate does, so the batch is not copied again when it
+            # is sent to the main process.
+            for value in batch.values():
+                value.share_memory_()
+        # Get the reads of the whole batch in flight before building samples.
+        spans_list = self.dataset.prefetch(indices)
+        for i, spans in enumerate(spans_list):
+            self.dataset.build_sample_into(spans, {key: value[i].numpy() for key, value in batch.items()})
+        return batch
+
+
+def _build_enc_dec_sample(contexts, ctx_eod_mask, targets_out, labels_out,
+                          target_data, sentinel_pos, target_starts,
+                          target_lengths, sentinel_ids, eod_id, pad_id):
+    """Replace the sentinels in `contexts` (in place) with local sentinel ids
+    and build the decoder inputs. The k-th sentinel sits at
+    contexts[sentinel_pos[k]] and its target, which starts with the sentinel
+    itself, at target_data[target_starts[k]:target_starts[k] + target_lengths[k]].
+    Fills the context eod mask and the pad-filled targets and labels, whose
+    length is the decoder sequence length, in place.
+    Python version of `helpers.build_enc_dec_sample`."""
+    dec_seq_length = len(targets_out)
+    ctx_eod_mask[:] = 0
+    targets_list = [None] * len(sentinel_pos)
+    # Sentinels are numbered in context order, but their targets are read in
+    # file order so the page faults (and any readahead) walk forward.
+    for k in np.argsort(target_starts, kind='stable'):
+        i = sentinel_pos[k]
+        target_arr = target_data[target_starts[k]:target_starts[k] + target_lengths[k]]
+
+        # mark the eod pos in context
+        ctx_eod_mask[i] = (target_arr == eod_id).any()
+
+        assert int(target_arr[0]) == contexts[i], (int(target_arr[0]), int(contexts[i]))
+        contexts[i] = sentinel_ids[k]
+        # copy out of the read-only mmap to replace the leading sentinel
+        target = target_arr.astype(np.int64)
+        target[0] = sentinel_ids[k]
+        targets_list[k] = target
+
+    targets = np.concatenate([[1], *targets_list, [sentinel_ids[len(sentinel_pos)]]]).astype(np.int64)
+    if len(targets) > dec_seq_length + 1:
+        print("targets length({}) maybe too long, cut to dec_seq_length + 1({})".format(len(targets), dec_seq_length + 1))
+
+    # labels are the targets shifted by one, anything past n stays pad
+    n = min(len(targets) - 1, dec_seq_length)
+    targets_out[:n] = targets[:n]
+    targets_out[n:] = pad_id
+    labels_out[:n] = targets[1:n + 1]
+    labels_out[n:] = pad_id
 
 
 def _build_index_mappings(name, data_prefix, documents, sizes,
@@ -319,6 +377,10 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     _filename += '_{}ns'.format(num_samples)
     _filename += '_{}sl'.format(seq_length)
     _filename += '_{}s'.format(seed)
+    # Bumped whenever the maps built for the same arguments change, so stale
+    # maps cached by older code are rebuilt instead of loaded. v2: shuffle-idx
+    # is drawn from a PCG64 Generator instead of the RandomState stream.
+    _filename += '_v2'
     doc_idx_filename = _filename + '_doc_idx.npy'
     sample_idx_filename = _filename + '_sample_idx.npy'
     shuffle_idx_filename = _filename + '_shuffle_idx.npy'
@@ -339,17 +401,24 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
                          '(seconds): {:4f}'.format(time.time() - start_time))
             # sample-idx.
             start_time = time.time()
-            # Use C++ implementation for speed.
-            # First compile and then import.
-            from data.dataset_utils import compile_helper
-            compile_helper()
-            from data import helpers
             assert doc_idx.dtype == np.int32
             assert sizes.dtype == np.int32
-            sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
-                                                  num_epochs, tokens_per_epoch)
-            # sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
-            #                               num_epochs, tokens_per_epoch)
+            try:
+                # Use C++ implementation for speed.
+                # First compile and then import.
+                from data.dataset_utils import compile_helper
+                compile_helper()
+                from data import helpers
+                sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
+                                                      num_epochs, tokens_per_epoch)
+            except ImportError:
+                # Fall back to the numba-compiled (or plain python) version
+                # when the C++ helpers cannot be built on this machine.
+                print_rank_0(' > WARNING: could not import C++ helpers, building '
+                             'sample-idx with {}'.format(
+                                 'numba' if numba_available else 'python'))
+                sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
+                                               num_epochs, tokens_per_epoch)
             np.save(sample_idx_filename, sample_idx, allow_pickle=True)
             print_rank_0(' > elasped time to build and save sample-idx mapping '
                          '(seconds): {:4f}'.format(time.time() - start_time))
@@ -357,14 +426,16 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
             start_time = time.time()
             # -1 is due to data structure used to retieve the index:
             #    sample i --> [sample_idx[i], sample_idx[i+1])
-            shuffle_idx = _build_shuffle_idx(sample_idx.shape[0] - 1, np_rng)
+            shuffle_idx = _build_shuffle_idx(sample_idx.shape[0] - 1, seed)
             np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
             print_rank_0(' > elasped time to build and save shuffle-idx mapping'
                          ' (seconds): {:4f}'.format(time.time() - start_time))
 
     # This should be a barrier but nccl barrier assumes
     # device_index=rank which is not the case for model
-    # parallel case
+    # parallel case. The maps are built by one rank per node (rank % 8 == 0)
+    # on its own file system, so a broadcast of a "files exist" flag from a
+    # single rank would not wait for the other builders.
     counts = torch.cuda.LongTensor([1])
     torch.distributed.all_reduce(counts, group=mpu.get_data_parallel_group())
     assert counts[0].item() == torch.distributed.get_world_size(
@@ -375,14 +446,26 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     print_rank_0(' > loading doc-idx mapping from {}'.format(
         doc_idx_filename))
     doc_idx = np.load(doc_idx_filename, allow_pickle=True, mmap_mode='r')
+    # doc-idx and shuffle-idx are read at random positions, readahead only
+    # wastes page cache on them. sample-idx is read as (idx, idx + 1) pairs
+    # and keeps the default.
+    _madvise_mapping(doc_idx, 'MADV_RANDOM')
     print_rank_0(' > loading sample-idx mapping from {}'.format(
         sample_idx_filename))
     sample_idx = np.load(sample_idx_filename, allow_pickle=True, mmap_mode='r')
     print_rank_0(' > loading shuffle-idx mapping from {}'.format(
         shuffle_idx_filename))
     shuffle_idx = np.load(shuffle_idx_filename, allow_pickle=True, mmap_mode='r')
+    _madvise_mapping(shuffle_idx, 'MADV_RANDOM')
+    # Start reading all three maps in the background now, rather than
+    # faulting their pages in one by one during the first iterations.
+    for mapping in (doc_idx, sample_idx, shuffle_idx):
+        _madvise_mapping(mapping, 'MADV_WILLNEED')
     print_rank_0('    loaded indexed file in {:3.3f} seconds'.format(
         time.time() - start_time))
+    # Both are built as int32, keep them that way to halve their footprint.
+    assert doc_idx.dtype == np.int32
+    assert sample_idx.dtype == np.int32
     print_rank_0('    total number of samples: {}'.format(
         sample_idx.shape[0]))
     print_rank_0('    total number of epochs: {}'.format(num_epochs))
@@ -390,9 +473,20 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     return doc_idx, sample_idx, shuffle_idx
 
 
+def _madvise_mapping(array, advice):
+    """Apply the named madvise advice to the mapping behind a memory-mapped
+    numpy array. No-op if the platform or the array does not support it."""
+    advice = getattr(mmap, advice, None)
+    mapping = getattr(array, '_mmap', None)
+    if advice is None or mapping is None:
+        return
+    mapping.madvise(advice)
+
+
 def _num_tokens(documents, sizes):
     """Total number of tokens in the dataset."""
-    return np.sum(sizes[documents])
+    # Accumulate in int64, the total overflows the int32 document sizes.
+    return np.sum(sizes[documents], dtype=np.int64)
 
 
 def _num_epochs(tokens_per_epoch, seq_length, num_samples):
@@ -413,10 +507,7 @@ def _num_epochs(tokens_per_epoch, seq_length, num_samples):
 def _build_doc_idx(documents, num_epochs, np_rng):
     """Build an array with length = number-of-epochs * number-of-dcuments.
     Each index is mapped to a corresponding document."""
-    doc_idx = np.mgrid[0:num_epochs, 0:len(documents)][1]
-    doc_idx[:] = documents
-    doc_idx = doc_idx.reshape(-1)
-    doc_idx = doc_idx.astype(np.int32)
+    doc_idx = np.tile(documents.astype(np.int32, copy=False), num_epochs)
     np_rng.shuffle(doc_idx)
     return doc_idx
 
@@ -430,7 +521,7 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
 
     # Total number of samples. For -1 see comments in `_num_epochs`.
     num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
-    sample_idx = np.zeros([num_samples + 1, 2], dtype=np.int32)
+    sample_idx = np.zeros((num_samples + 1, 2), dtype=np.int32)
 
     # Index into sample_idx.
     sample_index = 0
@@ -439,8 +530,8 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
     # Begining offset for each document.
     doc_offset = 0
     # Start with first document and no offset.
-    sample_idx[sample_index][0] = doc_idx_index
-    sample_idx[sample_index][1] = doc_offset
+    sample_idx[sample_index, 0] = doc_idx_index
+    sample_idx[sample_index, 1] = doc_offset
     sample_index += 1
     while sample_index <= num_samples:
         # Start with a fresh sequence.
@@ -463,18 +554,24 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
                 doc_idx_index += 1
                 doc_offset = 0
         # Record the sequence.
-        sample_idx[sample_index][0] = doc_idx_index
-        sample_idx[sample_index][1] = doc_offset
+        sample_idx[sample_index, 0] = doc_idx_index
+        sample_idx[sample_index, 1] = doc_offset
         sample_index += 1
 
     return sample_idx
 
 
-def _build_shuffle_idx(size, np_rng):
+if numba_available:
+    _build_sample_idx = numba.njit(cache=True)(_build_sample_idx)
+
+
+def _build_shuffle_idx(size, seed):
     """Build the range [0, size) and shuffle."""
     dtype_ = np.uint32
     if size >= (np.iinfo(np.uint32).max - 1):
         dtype_ = np.int64
     shuffle_idx = np.arange(start=0, stop=size, step=1, dtype=dtype_)
-    np_rng.shuffle(shuffle_idx)
+    # PCG64 Generator, faster than the legacy RandomState shuffle.
+    rng = np.random.default_rng(seed)
+    rng.shuffle(shuffle_idx)
     return shuffle_idx
@@ -22,10 +22,12 @@
 #include <iostream>
 #include <limits>
 #include <math.h>
+#include <numeric>
 #include <stdexcept>
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
 #include <random>
+#include <vector>
 
 namespace py = pybind11;
 using namespace std;
@@ -122,6 +124,109 @@ py::array build_sample_idx(const py::array_t<int32_t>& sizes_,
 }
 
 
+template<typename DataT>
+void build_enc_dec_sample(py::array_t<int64_t>& contexts_,
+			  py::array_t<int64_t>& ctx_eod_mask_,
+			  py::array_t<int64_t>& targets_,
+			  py::array_t<int64_t>& labels_,
+			  const py::array_t<DataT>& target_data_,
+			  const py::array_t<int64_t>& sentinel_pos_,
+			  const py::array_t<int64_t>& target_starts_,
+			  const py::array_t<int64_t>& target_lengths_,
+			  const py::array_t<int64_t>& sentinel_ids_,
+			  const int64_t eod_id,
+			  const int64_t pad_id) {
+    /* Builds one encoder-decoder sample in place. The k-th sentinel sits at
+       contexts[sentinel_pos[k]] and its target, which starts with the
+       sentinel itself, is target_data[target_starts[k]:+target_lengths[k]].
+       Sentinels in contexts are replaced with the local sentinel ids, and
+       the context eod mask and the pad-filled decoder targets and labels
+       are written to the given arrays, whose length is dec_seq_length.*/
+
+    // Remove bound checks.
+    auto contexts = contexts_.mutable_unchecked<1>();
+    auto target_data = target_data_.template unchecked<1>();
+    auto sentinel_pos = sentinel_pos_.unchecked<1>();
+    auto target_starts = target_starts_.unchecked<1>();
+    auto target_lengths = target_lengths_.unchecked<1>();
+    auto sentinel_ids = sentinel_ids_.unchecked<1>();
+
+    const int64_t num_sentinels = sentinel_pos_.shape(0);
+    if (num_sentinels >= sentinel_ids_.shape(0)) {
+      throw std::out_of_range("not enough sentinel ids for the sample");
+    }
+
+    if (ctx_eod_mask_.shape(0) != contexts_.shape(0) ||
+	labels_.shape(0) != targets_.shape(0)) {
+      throw std::invalid_argument("output lengths do not match");
+    }
+    const int64_t dec_seq_length = targets_.shape(0);
+    auto ctx_eod_mask = ctx_eod_mask_.mutable_unchecked<1>();
+    auto targets = targets_.mutable_unchecked<1>();
+    auto labels = labels_.mutable_unchecked<1>();
+    for (int64_t i = 0; i < contexts_.shape(0); ++i) {
+      ctx_eod_mask(i) = 0;
+    }
+    for (int64_t i = 0; i < dec_seq_length; ++i) {
+      targets(i) = pad_id;
+      labels(i) = pad_id;
+    }
+
+    // The full decoder sequence is [1, target_0, ..., target_n, last sentinel],
+    // seq_starts[k] is where target_k starts in it. Token p of the sequence
+    // goes to targets[p] and labels[p - 1], within the first n positions.
+    std::vector<int64_t> seq_starts(num_sentinels + 1);
+    seq_starts[0] = 1;
+    for (int64_t k = 0; k < num_sentinels; ++k) {
+      seq_starts[k + 1] = seq_starts[k] + target_lengths(k);
+    }
+    const int64_t length = seq_starts[num_sentinels] + 1;
+    const int64_t n = std::min(length - 1, dec_seq_length);
+    auto put = [&](const int64_t p, const int64_t token) {
+      if (p < n) {
+	targets(p) = token;
+      }
+      if (p >= 1 && p <= n) {
+	labels(p - 1) = token;
+      }
+    };
+
+    put(0, 1);
+    // Sentinels are numbered in context order, but their targets are read in
+    // file order so the page faults (and any readahead) walk forward.
+    std::vector<int64_t> read_order(num_sentinels);
+    std::iota(read_order.begin(), read_order.end(), 0);
+    std::stable_sort(read_order.begin(), read_order.end(),
+		     [&](const int64_t a, const int64_t b) {
+		       return target_starts(a) < target_starts(b);
+		     });
+    for (const auto k : read_order) {
+      const auto i = sentinel_pos(k);
+      const auto start = target_starts(k);
+      if (static_cast<int64_t>(target_data(start)) != contexts(i)) {
+	throw std::runtime_error("target does not start with its sentinel");
+      }
+      // Replace with local sentinel ids.
+      contexts(i) = sentinel_ids(k);
+      put(seq_starts[k], sentinel_ids(k));
+      for (int64_t j = 1; j < target_lengths(k); ++j) {
+	const int64_t token = target_data(start + j);
+	// Mark the eod pos in context.
+	if (token == eod_id) {
+	  ctx_eod_mask(i) = 1;
+	}
+	put(seq_starts[k] + j, token);
+      }
+    }
+    put(length - 1, sentinel_ids(num_sentinels));
+
+    if (length > dec_seq_length + 1) {
+      cout << "targets length(" << length << ") maybe too long, cut to "
+	"dec_seq_length + 1(" << dec_seq_length + 1 << ")" << endl << std::flush;
+    }
+}
+
+
 inline int32_t get_target_sample_len(const int32_t short_seq_ratio,
 				     const int32_t max_length,
 				     std::mt19937& rand32_gen) {
@@ -397,4 +502,28 @@ py::array build_mapping(const py::array_t<int64_t>& docs_,
 PYBIND11_MODULE(helpers, m) {
     m.def("build_mapping", &build_mapping);
     m.def("build_sample_idx", &build_sample_idx);
+    // Arrays must already have the exact dtype: a converted copy of contexts
+    // or of the outputs would lose the in-place writes, and casting the target data
+    // would copy the whole file and could truncate it.
+    m.def("build_enc_dec_sample", &build_enc_dec_sample<uint16_t>,
+	  py::arg("contexts").noconvert(), py::arg("ctx_eod_mask").noconvert(),
+	  py::arg("targets").noconvert(), py::arg("labels").noconvert(),
+	  py::arg("target_data").noconvert(),
+	  py::arg("sentinel_pos").noconvert(), py::arg("target_starts").noconvert(),
+	  py::arg("target_lengths").noconvert(), py::arg("sentinel_ids").noconvert(),
+	  py::arg("eod_id"), py::arg("pad_id"));
+    m.def("build_enc_dec_sample", &build_enc_dec_sample<int32_t>,
+	  py::arg("contexts").noconvert(), py::arg("ctx_eod_mask").noconvert(),
+	  py::arg("targets").noconvert(), py::arg("labels").noconvert(),
+	  py::arg("target_data").noconvert(),
+	  py::arg("sentinel_pos").noconvert(), py::arg("target_starts").noconvert(),
+	  py::arg("target_lengths").noconvert(), py::arg("sentinel_ids").noconvert(),
+	  py::arg("eod_id"), py::arg("pad_id"));
+    m.def("build_enc_dec_sample", &build_enc_dec_sample<int64_t>,
+	  py::arg("contexts").noconvert(), py::arg("ctx_eod_mask").noconvert(),
+	  py::arg("targets").noconvert(), py::arg("labels").noconvert(),
+	  py::arg("target_data").noconvert(),
+	  py::arg("sentinel_pos").noconvert(), py::arg("target_starts").noconvert(),
+	  py::arg("target_lengths").noconvert(), py::arg("sentinel_ids").noconvert(),
+	  py::arg("eod_id"), py::arg("pad_id"));
 }
@@ -11,6 +11,7 @@
 #    An empty sentence no longer separates documents.
 
 from functools import lru_cache
+import mmap
 import os
 import shutil
 import struct
@@ -466,6 +467,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
             _warmup_mmap_file(data_file_path(self._path))
         print_rank_0("    creating numpy buffer of mmap...")
         self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='r', order='C')
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Items are read at shuffled positions, default readahead would
+            # mostly pull in pages that are evicted before they are used.
+            self._bin_buffer_mmap._mmap.madvise(mmap.MADV_RANDOM)
         print_rank_0("    creating memory view of numpy buffer...")
         self._bin_buffer = memoryview(self._bin_buffer_mmap)
 
@@ -512,6 +517,42 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                                  count=length, offset=ptr)
         return np_array
 
+    def will_need(self, idx, offset=0, length=None):
+        """ Advises the kernel that a portion of an item will be read soon so
+        its pages are read ahead instead of faulted in one by one.
+
+        Takes the same arguments as get(). No-op where madvise is unavailable.
+        """
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        ptr, size = self._index[idx]
+        if length is None:
+            length = size - offset
+        itemsize = np.dtype(self._index.dtype).itemsize
+        if length * itemsize == 0:
+            # nothing to read, and an empty item at the end of the file would
+            # put start out of the mapping's bounds
+            return
+        start = int(ptr) + offset * itemsize
+        end = start + length * itemsize
+        # madvise requires a page aligned start address
+        start -= start % mmap.PAGESIZE
+        self._bin_buffer_mmap._mmap.madvise(mmap.MADV_WILLNEED, start, end - start)
+
+    def element_offset(self, idx):
+        """ Returns the position of item idx in `data`, counted in elements. """
+        ptr, _ = self._index[idx]
+        return int(ptr) // np.dtype(self._index.dtype).itemsize
+
+    @property
+    def data(self):
+        """ The whole data file as a flat array, without copying. """
+        return np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
+
+    @property
+    def dtype(self):
+        return self._index.dtype
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -92,9 +92,10 @@ def broadcast_data(keys, data, datatype):
     if get_model_parallel_rank() == 0:
         # Check that all keys have the same data type.
         _check_data_types(keys, data, datatype)
-        # Flatten the data associated with the keys
+        # Flatten the data associated with the keys. Copy each key on its own
+        # so copies out of pinned memory are asynchronous.
         flatten_data = torch.cat(
-            [data[key].contiguous().view(-1) for key in keys], dim=0).cuda()
+            [data[key].contiguous().view(-1).cuda(non_blocking=True) for key in keys], dim=0)
     else:
         flatten_data = torch.empty(total_numel,
                                    device=torch.cuda.current_device(),
@@ -35,6 +35,7 @@ from utils import print_rank_0, save_rank_0
 import torch.distributed as dist
 
 from data.enc_dec_dataset import build_train_valid_test_datasets
+from data.enc_dec_dataset import EncDecBatchDataset
 from samplers import DistributedBatchSampler
 
 
@@ -639,9 +640,11 @@ def make_data_loader(dataset):
                                             drop_last=True,
                                             rank=rank,
                                             world_size=world_size)
-    # Torch dataloader.
-    return torch.utils.data.DataLoader(dataset,
-                                       batch_sampler=batch_sampler,
+    # Torch dataloader. The batch sampler is passed as a plain sampler with
+    # automatic batching disabled, each worker builds a whole batch at once.
+    return torch.utils.data.DataLoader(EncDecBatchDataset(dataset),
+                                       sampler=batch_sampler,
+                                       batch_size=None,
                                        num_workers=num_workers,
                                        pin_memory=True)
 
@@ -787,17 +790,17 @@ def build_train_valid_test_data_iterators(
 
     # Shift the start iterations.
     if train_dataloader is not None:
-        train_dataloader.batch_sampler.start_iter = args.iteration % \
+        train_dataloader.sampler.start_iter = args.iteration % \
             len(train_dataloader)
         print_rank_0('setting training data start iteration to {}'.
-                     format(train_dataloader.batch_sampler.start_iter))
+                     format(train_dataloader.sampler.start_iter))
     if valid_dataloader is not None:
         start_iter_val = (args.iteration // args.eval_interval) * \
             args.eval_iters
-        valid_dataloader.batch_sampler.start_iter = start_iter_val % \
+        valid_dataloader.sampler.start_iter = start_iter_val % \
             len(valid_dataloader)
         print_rank_0('setting validation data start iteration to {}'.
-                     format(valid_dataloader.batch_sampler.start_iter))
+                     format(valid_dataloader.sampler.start_iter))
 
     # Build iterators.
     if train_dataloader is not None: